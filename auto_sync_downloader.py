@@ -5,13 +5,24 @@ Automatically pulls existing transcripts from GitHub before starting
 Automatically pushes new transcripts after downloading
 """
 
-# !pip -q install youtube-transcript-api pandas
+# !pip -q install youtube-transcript-api pandas orjson
 import pandas as pd
+import numpy as np
+import asyncio
 import time
 import random
 import os
-import json
+import sys
+import orjson
 import subprocess
+import shutil
+import socket
+import functools
+import urllib.parse
+import atexit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.connection import allowed_gai_family
 from youtube_transcript_api import YouTubeTranscriptApi
 import youtube_transcript_api._errors as yt_errors
 
@@ -25,32 +36,117 @@ VIDEO_ID_COLUMN = "video_id"
 # GitHub settings
 GITHUB_REPO = "https://github.com/Sanjidx090/ytranscript.git"
 GITHUB_TOKEN = ""  # Optional: for private repos
+REPO_CACHE_DIR = os.path.expanduser("~/.cache/ytranscript_repo")  # Kept between runs
 ENABLE_AUTO_SYNC = True  # Set to False to disable GitHub sync
 
 # Chunking
 MIN_CHUNK_DURATION = 20
 MAX_CHUNK_DURATION = 30
+CHUNK_FORMAT = "jsonl"  # "jsonl" or "parquet" (needs: pip install pyarrow)
 
 # Batch
 START_INDEX = 0
 BATCH_SIZE = 50
+GIT_ADD_BATCH = 1000  # Paths per 'git add' call (stays under ARG_MAX)
+REPACK_EVERY = 10  # Full 'git repack' after this many batches on one checkout
+CONCURRENCY = 4  # Videos fetched at the same time
 
 # Safety
-MIN_WAIT = 2.0
-MAX_WAIT = 4.0
-SAVE_EVERY = 5
+STARTUP_JITTER = 30.0  # Random delay before the first request (seconds)
+MEAN_WAIT = 3.0  # Average pause between videos (exponential)
+MIN_WAIT = 1.0
+MAX_WAIT = 10.0
+MAX_RETRIES = 6  # Attempts per video while rate limited
+MAX_BACKOFF = 64.0  # Cap on a single backoff wait (seconds)
+RATE_LIMIT_STREAK = 3  # Stop the batch after this many videos fail every retry
 
 # ==============================
 # GITHUB SYNC FUNCTIONS
 # ==============================
 
-def run_git_command(cmd):
-    """Run git command silently"""
+# Older runs cloned straight into the working directory; keep using that checkout
+REPO_DIR = '.' if os.path.isdir('.git') else REPO_CACHE_DIR
+# Where the progress file lives inside the repo, whatever OUTPUT_DIR ends up pointing at
+PROGRESS_REPO_PATH = f"{OUTPUT_DIR.replace(os.sep, '/')}/download_progress.json"
+
+# Only the git processes started here see this: if one would refresh the index
+# opportunistically (status, worktree diffs) it skips the index lock instead.
+# It doesn't stop other programs' git calls (e.g. an IDE's git status) from taking it
+GIT_ENV = {**os.environ, 'GIT_OPTIONAL_LOCKS': '0'}
+
+def run_git_command(args, input=None):
+    """Run git command (argument list, no shell) silently inside the repo checkout"""
+    return git_output(args, input) is not None
+
+def git_output(args, input=None):
+    """Like run_git_command, but return stdout (None if the command failed)"""
     try:
-        subprocess.run(cmd, shell=True, capture_output=True, check=True)
-        return True
-    except:
-        return False
+        return subprocess.run(args, input=input, capture_output=True, check=True,
+                              cwd=REPO_DIR, env=GIT_ENV).stdout
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+def with_token(url, token):
+    """Add an access token to an https:// repo URL"""
+    parts = urllib.parse.urlsplit(url)
+    netloc = f"{urllib.parse.quote(token, safe='')}@{parts.netloc}"
+    return urllib.parse.urlunsplit(parts._replace(netloc=netloc))
+
+def repo_path(path):
+    """Path relative to the checkout root with / separators, as git expects"""
+    rel = os.path.relpath(os.path.realpath(path), os.path.realpath(REPO_DIR))
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep) or os.path.isabs(rel):
+        raise ValueError(f"{path} is outside the repo checkout {REPO_DIR}")
+    return rel.replace(os.sep, '/')
+
+def merge_into(src, dst):
+    """Move src's entries into dst; shard folders are merged, anything already in dst wins"""
+    os.makedirs(dst, exist_ok=True)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            target = os.path.join(dst, entry.name)
+            if not os.path.lexists(target):
+                shutil.move(entry.path, target)
+            elif entry.is_dir() and len(entry.name) == 2 and os.path.isdir(target):
+                merge_into(entry.path, target)
+
+def adopt_local_output(repo_output_dir):
+    """Move transcripts from a real OUTPUT_DIR (e.g. a run without sync) into the checkout"""
+    print(f"📦 Moving existing {OUTPUT_DIR}/ into the repo checkout...")
+    local_progress = os.path.join(OUTPUT_DIR, 'download_progress.json')
+    repo_progress = os.path.join(repo_output_dir, 'download_progress.json')
+    completed = set()
+    for path in (local_progress, repo_progress):
+        try:
+            with open(path, 'rb') as f:
+                completed.update(orjson.loads(f.read()).get('completed', []))
+        except (OSError, ValueError, AttributeError):
+            pass
+    
+    # The adopted folders aren't committed yet; have the next push pick them up
+    if os.path.exists(import_marker()):
+        os.remove(import_marker())
+    
+    # The two progress files are merged below instead of one replacing the other
+    if os.path.exists(local_progress):
+        os.remove(local_progress)
+    merge_into(OUTPUT_DIR, repo_output_dir)
+    if completed:
+        with open(repo_progress, 'wb') as f:
+            f.write(orjson.dumps({'completed': sorted(completed), 'timestamp': time.time()},
+                                option=orjson.OPT_INDENT_2))
+    # Whatever is left duplicated a folder already in the checkout
+    shutil.rmtree(OUTPUT_DIR)
+
+def link_output_dir(repo_output_dir):
+    """Expose the checkout's transcripts at OUTPUT_DIR (symlink, or use it directly)"""
+    global OUTPUT_DIR, progress_file
+    try:
+        os.symlink(repo_output_dir, OUTPUT_DIR, target_is_directory=True)
+    except OSError:
+        # e.g. Windows without symlink privilege: write into the checkout directly
+        OUTPUT_DIR = repo_output_dir
+        progress_file = os.path.join(OUTPUT_DIR, "download_progress.json")
 
 def pull_from_github():
     """Pull existing transcripts from GitHub"""
@@ -62,33 +158,237 @@ def pull_from_github():
     print("=" * 70)
     print()
     
+    # git runs inside REPO_DIR, so it has to exist before the first command
+    os.makedirs(REPO_DIR, exist_ok=True)
+    
+    # Transcripts live inside the checkout; expose them at OUTPUT_DIR. The link
+    # may dangle until the clone below creates its target.
+    repo_output_dir = os.path.abspath(os.path.join(REPO_DIR, OUTPUT_DIR))
+    if os.path.abspath(OUTPUT_DIR) != repo_output_dir and not os.path.lexists(OUTPUT_DIR):
+        link_output_dir(repo_output_dir)
+    
     # Configure git
-    run_git_command('git config --global user.name "Auto Sync"')
-    run_git_command('git config --global user.email "sync@auto.com"')
-    
-    # Check if already a repo
-    if os.path.exists('.git'):
-        print("📦 Pulling latest changes...")
-        if run_git_command('git pull origin main'):
-            print("   ✅ Pulled successfully")
+    run_git_command(['git', 'config', '--global', 'user.name', 'Auto Sync'])
+    run_git_command(['git', 'config', '--global', 'user.email', 'sync@auto.com'])
+    
+    # Reuse the checkout from earlier runs if there is one
+    if os.path.exists(os.path.join(REPO_DIR, '.git')):
+        print("📦 Fetching latest changes...")
+        if sync_with_origin("Auto-sync: re-applied unpushed videos"):
+            print("   ✅ Updated successfully")
         else:
-            print("   ⚠️  Pull failed (continuing anyway)")
+            print("   ⚠️  Fetch failed (continuing anyway)")
     else:
         print("🆕 Cloning repository...")
         repo_url = GITHUB_REPO
         if GITHUB_TOKEN:
-            repo_url = GITHUB_REPO.replace('https://', f'https://{GITHUB_TOKEN}@')
+            repo_url = with_token(GITHUB_REPO, GITHUB_TOKEN)
         
-        if run_git_command(f'git clone {repo_url} .'):
+        # Blobless shallow clone: only the tip commit, file contents fetched on demand
+        if run_git_command(['git', 'clone', '--filter=blob:none', '--depth=1', '--single-branch',
+                            '--branch', 'main', repo_url, '.']):
+            print("   ✅ Cloned successfully")
+        elif run_git_command(['git', 'clone', repo_url, '.']):
+            # Server doesn't support partial clone (or has no main branch yet)
             print("   ✅ Cloned successfully")
         else:
             print("   ⚠️  Clone failed (starting fresh)")
-            run_git_command('git init')
-            run_git_command(f'git remote add origin {repo_url}')
+            run_git_command(['git', 'init'])
+            # Commit to main like everything else here, whatever git's default branch is
+            run_git_command(['git', 'symbolic-ref', 'HEAD', 'refs/heads/main'])
+            run_git_command(['git', 'remote', 'add', 'origin', repo_url])
+    
+    # Index v4 + untracked cache for a repo with very many files; the builtin
+    # fsmonitor daemon only exists on macOS and Windows
+    run_git_command(['git', 'config', 'feature.manyFiles', 'true'])
+    if sys.platform in ('darwin', 'win32'):
+        run_git_command(['git', 'config', 'core.fsmonitor', 'true'])
+    
+    os.makedirs(repo_output_dir, exist_ok=True)
+    
+    # A real folder from a run outside the checkout: fold it in, then link it
+    if (os.path.abspath(OUTPUT_DIR) != repo_output_dir
+            and os.path.isdir(OUTPUT_DIR) and not os.path.islink(OUTPUT_DIR)):
+        adopt_local_output(repo_output_dir)
+        link_output_dir(repo_output_dir)
     
     print()
 
-def push_to_github(video_count):
+def unpushed_files(base):
+    """(path, bytes) for files HEAD added or changed since base, the last known origin/main.
+    
+    Returns None when that can't be worked out, so callers never reset over
+    commits that only exist locally.
+    """
+    if not run_git_command(['git', 'rev-parse', '-q', '--verify', 'HEAD']):
+        return []  # No commits yet, nothing to lose
+    ahead = git_output(['git', 'rev-list', '--max-count=1', 'refs/remotes/origin/main..HEAD'])
+    if ahead is None:
+        return None
+    if not ahead.strip():
+        return []
+    
+    if base is None:
+        names = git_output(['git', 'ls-tree', '-r', '-z', '--name-only', 'HEAD'])
+    else:
+        names = git_output(['git', 'diff', '--name-only', '-z', '--diff-filter=AM', base, 'HEAD'])
+    if not names:
+        return None
+    
+    files = []
+    for name in filter(None, names.decode('utf-8').split('\0')):
+        data = git_output(['git', 'show', f'HEAD:{name}'])
+        if data is None:
+            return None
+        files.append((os.path.join(REPO_DIR, name), data))
+    return files
+
+def merge_progress(data):
+    """Union our progress file with the one on origin/main"""
+    theirs = git_output(['git', 'show', f"refs/remotes/origin/main:{PROGRESS_REPO_PATH}"])
+    try:
+        ours = orjson.loads(data)
+        completed = set(ours.get('completed', [])) | set(orjson.loads(theirs).get('completed', []))
+    except (TypeError, ValueError):
+        return data
+    ours['completed'] = sorted(completed)
+    return orjson.dumps(ours, option=orjson.OPT_INDENT_2)
+
+def sync_with_origin(message):
+    """Fetch origin/main and move commits that never got pushed on top of it"""
+    base = git_output(['git', 'rev-parse', '-q', '--verify', 'refs/remotes/origin/main'])
+    if not run_git_command(['git', 'fetch', '--depth=1', 'origin', 'main']):
+        return False
+    
+    files = unpushed_files(base.decode().strip() if base else None)
+    if files is None:
+        print("   ⚠️  Local commits not on GitHub could not be re-applied; leaving the checkout as is")
+        return False
+    if not files:
+        return run_git_command(['git', 'reset', '--hard', 'origin/main'])
+    
+    # Another platform pushed first; re-commit our files instead of throwing them away
+    print(f"   ↪️  Re-applying {len(files)} unpushed files on top of origin/main")
+    files = [(path, merge_progress(data) if repo_path(path) == PROGRESS_REPO_PATH else data)
+             for path, data in files]
+    return fast_import_commit(files, message, parent='refs/remotes/origin/main')
+
+def fast_import_commit(files, message, parent='refs/heads/main'):
+    """Commit (path, bytes) pairs onto main with git fast-import, skipping the index scan.
+    
+    With a parent other than main, main is moved onto that parent and the
+    working tree is reset to the result.
+    """
+    head = git_output(['git', 'symbolic-ref', '-q', 'HEAD'])
+    if (head is None or head.strip() != b'refs/heads/main'
+            or not run_git_command(['git', 'rev-parse', '--verify', '-q', parent])):
+        return False
+    
+    # Raises ValueError for files outside the checkout, before anything is written
+    paths = [repo_path(path) for path, data in files]
+    
+    rebase = parent != 'refs/heads/main'
+    try:
+        # --force: moving main onto another parent is not a fast-forward
+        proc = subprocess.Popen(['git', 'fast-import', '--quiet'] + (['--force'] if rebase else []),
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                cwd=REPO_DIR, env=GIT_ENV)
+    except OSError:
+        return False
+    try:
+        for mark, (path, data) in enumerate(files, start=1):
+            proc.stdin.write(b'blob\nmark :%d\ndata %d\n' % (mark, len(data)))
+            proc.stdin.write(data)
+            proc.stdin.write(b'\n')
+        
+        msg = message.encode('utf-8')
+        proc.stdin.write(b'commit refs/heads/main\n')
+        proc.stdin.write(b'committer Auto Sync <sync@auto.com> %d +0000\n' % int(time.time()))
+        proc.stdin.write(b'data %d\n%s\n' % (len(msg), msg))
+        proc.stdin.write(b'from %s^0\n' % parent.encode('utf-8'))
+        for mark, path in enumerate(paths, start=1):
+            proc.stdin.write(b'M 100644 :%d %s\n' % (mark, path.encode('utf-8')))
+        proc.stdin.write(b'\n')
+        proc.stdin.close()
+    except OSError:
+        pass
+    if proc.wait() != 0:
+        return False
+    
+    if rebase:
+        # The working tree is missing whatever arrived from origin
+        return run_git_command(['git', 'reset', '-q', '--hard', 'HEAD'])
+    
+    # The files are already on disk; point just their index entries at the new commit
+    run_git_command(['git', 'reset', '-q', '--pathspec-from-file=-', 'HEAD'],
+                    input='\n'.join(paths).encode('utf-8'))
+    return True
+
+def maintain_repo():
+    """Repack every REPACK_EVERY batches so per-batch packs and loose objects don't pile up"""
+    git_dir = os.path.join(REPO_DIR, '.git')
+    if not os.path.isdir(git_dir):
+        return
+    
+    counter_file = os.path.join(git_dir, 'auto_sync_batches')
+    try:
+        with open(counter_file) as f:
+            batches = int(f.read())
+    except (OSError, ValueError):
+        batches = 0
+    batches += 1
+    with open(counter_file, 'w') as f:
+        f.write(str(batches))
+    
+    if batches % REPACK_EVERY == 0:
+        print("🗜️  Repacking repository...")
+        run_git_command(['git', 'repack', '-adf', '--depth=50', '--window=250'])
+    run_git_command(['git', 'gc', '--auto'])
+
+def push_main(message):
+    """Push main, catching up with origin once if another platform pushed first"""
+    print("📤 Pushing...")
+    if run_git_command(['git', 'push', 'origin', 'main']):
+        print("   ✅ Pushed to GitHub!")
+    # Try creating branch if it doesn't exist
+    elif run_git_command(['git', 'push', '--set-upstream', 'origin', 'main']):
+        print("   ✅ Pushed to GitHub!")
+    # Rejected because another platform pushed first: rebuild on top of theirs and retry
+    elif sync_with_origin(message) and run_git_command(['git', 'push', 'origin', 'main']):
+        print("   ✅ Pushed to GitHub (after catching up with origin)!")
+    else:
+        # The commit stays local; the next run re-applies it and pushes it again
+        print("   ⚠️  Push failed (check token/permissions)")
+
+def import_marker():
+    """File that records this checkout's one-off import of existing folders"""
+    return os.path.join(REPO_DIR, '.git', 'auto_sync_imported')
+
+def import_pending():
+    """Whether folders already on disk still need their one-off import"""
+    return os.path.isdir(os.path.join(REPO_DIR, '.git')) and not os.path.exists(import_marker())
+
+def uncommitted_output_files():
+    """(path, bytes) for files under OUTPUT_DIR that git doesn't track yet.
+    
+    This scans the working tree, so it only runs once per checkout (and again
+    after a local folder was adopted), to pick up folders from earlier runs.
+    """
+    names = git_output(['git', 'ls-files', '--others', '--exclude-standard', '-z', '--',
+                        PROGRESS_REPO_PATH.rsplit('/', 1)[0]])
+    if names is None:
+        return None
+    
+    files = []
+    for name in filter(None, names.decode('utf-8').split('\0')):
+        if name.endswith('.tmp'):
+            continue
+        with open(os.path.join(REPO_DIR, name), 'rb') as f:
+            files.append((os.path.join(REPO_DIR, name), f.read()))
+    return files
+
+def push_to_github(video_count, new_files):
     """Push new transcripts to GitHub"""
     if not ENABLE_AUTO_SYNC:
         return
@@ -99,34 +399,58 @@ def push_to_github(video_count):
     print("=" * 70)
     print()
     
-    print("📦 Adding files...")
-    run_git_command('git add .')
+    message = f"Auto-sync: {video_count} videos"
+    # Folders from earlier runs that never got committed go in once, with this batch
+    existing = uncommitted_output_files() if import_pending() else None
+    if existing:
+        print(f"📦 Including {len(existing)} existing files that were never committed")
     
     print("💾 Committing...")
-    run_git_command(f'git commit -m "Auto-sync: {video_count} videos"')
-    
-    print("📤 Pushing...")
-    if run_git_command('git push origin main'):
-        print("   ✅ Pushed to GitHub!")
-    else:
-        # Try creating branch if it doesn't exist
-        if run_git_command('git push --set-upstream origin main'):
-            print("   ✅ Pushed to GitHub!")
-        else:
-            print("   ⚠️  Push failed (check token/permissions)")
+    with open(progress_file, 'rb') as f:
+        new_files = new_files + (existing or []) + [(progress_file, f.read())]
+    try:
+        # Keyed by repo path: the scan above also finds this batch's files
+        new_files = list({repo_path(path): (path, data) for path, data in new_files}.values())
+        paths = [repo_path(path) for path, data in new_files]
+    except ValueError as e:
+        print(f"   ⚠️  Not committing: {e}")
+        return
+    committed = fast_import_commit(new_files, message)
+    if not committed:
+        # No main branch to build on yet (fresh repo) - fall back to the index
+        print("📦 Adding files...")
+        for start in range(0, len(paths), GIT_ADD_BATCH):
+            batch = paths[start:start + GIT_ADD_BATCH]
+            run_git_command(['git', 'add', '--'] + batch)
+        committed = run_git_command(['git', 'commit', '-m', message])
+    if committed and existing is not None:
+        open(import_marker(), 'w').close()
     
+    push_main(message)
+    maintain_repo()
     print()
 
 # ==============================
 # SETUP
 # ==============================
 
+# Fail before any download if the chunks can't be written
+if CHUNK_FORMAT not in ('jsonl', 'parquet'):
+    sys.exit(f"❌ CHUNK_FORMAT must be 'jsonl' or 'parquet', not {CHUNK_FORMAT!r}")
+if CHUNK_FORMAT == 'parquet':
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        sys.exit("❌ CHUNK_FORMAT = 'parquet' needs pyarrow: pip install pyarrow")
+
+progress_file = os.path.join(OUTPUT_DIR, "download_progress.json")
+
 # Pull from GitHub first
 if ENABLE_AUTO_SYNC:
     pull_from_github()
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
-progress_file = os.path.join(OUTPUT_DIR, "download_progress.json")
 
 print("=" * 70)
 print("SMART DOWNLOADER WITH AUTO GITHUB SYNC")
@@ -140,36 +464,55 @@ print()
 # ==============================
 # LOAD VIDEO LIST
 # ==============================
-df = pd.read_csv(INPUT_CSV)
-all_video_ids = df[VIDEO_ID_COLUMN].dropna().astype(str).unique().tolist()
+# Only the ID column is needed; read it as text so IDs are never parsed as numbers
+df = pd.read_csv(INPUT_CSV, usecols=[VIDEO_ID_COLUMN], dtype={VIDEO_ID_COLUMN: str}, engine='c')
+all_video_ids = pd.unique(df[VIDEO_ID_COLUMN].dropna())
 print(f"📌 Total videos in CSV: {len(all_video_ids)}")
 
-# Check what's already downloaded (from GitHub or previous runs)
-downloaded = set()
-if os.path.exists(progress_file):
-    with open(progress_file, 'r') as f:
-        progress = json.load(f)
-        downloaded = set(progress.get('completed', []))
+# Check what's already downloaded (from GitHub or previous runs).
+# The progress file is the source of truth; only scan folders if it is missing.
+def scan_existing_folders():
+    """Collect video IDs from shard folders (and legacy flat folders) on disk"""
+    found = set()
+    with os.scandir(OUTPUT_DIR) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.name == '.git':
+                continue
+            if len(entry.name) != 2:
+                # Legacy layout: bangla_transcripts/<video_id>/
+                found.add(entry.name)
+                continue
+            with os.scandir(entry.path) as shard:
+                found.update(sub.name for sub in shard if sub.is_dir())
+    return found
 
-# Also check actual folders
-existing_folders = set()
-if os.path.exists(OUTPUT_DIR):
-    for item in os.listdir(OUTPUT_DIR):
-        item_path = os.path.join(OUTPUT_DIR, item)
-        if os.path.isdir(item_path) and item != '.git':
-            existing_folders.add(item)
+downloaded = None
+if os.path.exists(progress_file):
+    try:
+        with open(progress_file, 'rb') as f:
+            progress = orjson.loads(f.read())
+            downloaded = set(progress.get('completed', []))
+    except ValueError:
+        print("⚠️  Progress file is corrupt, rescanning folders")
 
-# Combine both
-downloaded = downloaded.union(existing_folders)
+if downloaded is None:
+    downloaded = scan_existing_folders()
 
 if downloaded:
     print(f"✅ Already downloaded: {len(downloaded)} videos (from GitHub or local)")
 
-remaining_videos = [vid for vid in all_video_ids if vid not in downloaded]
-batch_videos = remaining_videos[START_INDEX:START_INDEX + BATCH_SIZE]
+# Vectorized membership test; only the batch itself becomes a Python list
+remaining_videos = all_video_ids[~pd.Series(all_video_ids).isin(downloaded).to_numpy()]
+batch_videos = remaining_videos[START_INDEX:START_INDEX + BATCH_SIZE].tolist()
 
 if len(batch_videos) == 0:
     print("\n✅ All videos already downloaded!")
+    # Folders never committed (first synced run) or a batch whose push failed last
+    # time (re-applied at startup) still need pushing - there's no batch to carry them
+    if ENABLE_AUTO_SYNC and import_pending():
+        push_to_github(len(downloaded), [])
+    elif ENABLE_AUTO_SYNC and git_output(['git', 'rev-list', '--max-count=1', 'refs/remotes/origin/main..HEAD']):
+        push_main("Auto-sync: re-applied unpushed videos")
     exit(0)
 
 print(f"📝 Will download: {len(batch_videos)} videos in this batch")
@@ -178,7 +521,27 @@ print()
 # ==============================
 # API INSTANCE
 # ==============================
-api = YouTubeTranscriptApi()
+# Resolve each host once per run instead of once per new pooled connection.
+# Failed lookups raise, so they are never cached.
+socket.getaddrinfo = functools.lru_cache(maxsize=64)(socket.getaddrinfo)
+try:
+    # Same arguments urllib3 uses (AF_INET on hosts without IPv6), so the first fetch hits the cache
+    socket.getaddrinfo('www.youtube.com', 443, allowed_gai_family(), socket.SOCK_STREAM)
+except OSError:
+    pass
+
+# One shared session so every fetch reuses keep-alive connections to youtube.com
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+http_session.headers['User-Agent'] = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/124.0 Safari/537.36'
+)
+atexit.register(http_session.close)
+
+api = YouTubeTranscriptApi(http_client=http_session)
 
 # ==============================
 # CHUNKING FUNCTION
@@ -188,163 +551,233 @@ def chunk_smart_duration(segments, min_duration=20, max_duration=30):
     if not segments:
         return []
     
+    n = len(segments)
+    starts = np.fromiter((seg.start for seg in segments), float, n)
+    durs = np.fromiter((seg.duration for seg in segments), float, n)
+    ends = starts + durs
+    texts = [seg.text for seg in segments]
+    
+    # cum[k] = total duration of segments[:k]
+    cum = np.concatenate(([0.0], np.cumsum(durs)))
+    # A chunk holds at least one segment, so n targets is always enough
+    targets = np.random.uniform(min_duration, max_duration, size=n)
+    
     chunks = []
-    chunk_id = 0
     i = 0
     
-    while i < len(segments):
-        target_duration = random.uniform(min_duration, max_duration)
-        chunk_start = segments[i].start
-        chunk_segments = []
-        chunk_texts = []
-        current_duration = 0
+    while i < n:
+        base = cum[i]
+        # A chunk stops before segment k once it is at least min_duration long
+        # and has either reached its target or would pass max_duration with k
+        reached_min = int(np.searchsorted(cum, base + min_duration, 'left'))
+        reached_target = int(np.searchsorted(cum, base + targets[len(chunks)], 'left'))
+        overflow = int(np.searchsorted(cum, base + max_duration, 'right')) - 1
+        end = min(max(i + 1, reached_min, min(reached_target, overflow)), n)
         
-        while i < len(segments):
-            seg = segments[i]
-            seg_duration = seg.duration
-            
-            if not chunk_segments:
-                chunk_segments.append(seg)
-                chunk_texts.append(seg.text)
-                current_duration += seg_duration
-                i += 1
-                continue
-            
-            if current_duration < min_duration:
-                chunk_segments.append(seg)
-                chunk_texts.append(seg.text)
-                current_duration += seg_duration
-                i += 1
-                continue
-            
-            new_duration = current_duration + seg_duration
-            if current_duration >= target_duration or new_duration > max_duration:
-                break
-            
-            chunk_segments.append(seg)
-            chunk_texts.append(seg.text)
-            current_duration += seg_duration
-            i += 1
-        
-        if chunk_segments:
-            chunk_end = chunk_segments[-1].start + chunk_segments[-1].duration
-            chunks.append({
-                'chunk_id': chunk_id,
-                'start': chunk_start,
-                'end': chunk_end,
-                'duration': chunk_end - chunk_start,
-                'text': " ".join(chunk_texts),
-                'segments': len(chunk_segments)
-            })
-            chunk_id += 1
+        chunk_start = float(starts[i])
+        chunk_end = float(ends[end - 1])
+        chunks.append({
+            'chunk_id': len(chunks),
+            'start': chunk_start,
+            'end': chunk_end,
+            'duration': chunk_end - chunk_start,
+            'text': " ".join(texts[i:end]),
+            'segments': end - i
+        })
+        i = end
     
     return chunks
 
-# ==============================
-# DOWNLOAD FUNCTION
-# ==============================
-def download_transcript_chunks(video_id):
+def video_dir_for(video_id):
+    """Shard videos by the first 2 characters of the ID to keep directories small"""
+    return os.path.join(OUTPUT_DIR, video_id[:2], video_id)
+
+def write_file(path, data):
+    """Write bytes with raw os.write calls (no buffered file object)"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+def sync_dir(path):
+    """fsync a directory once, after all of a video's files are written"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return  # Windows can't open directories for fsync
+    dir_fd = os.open(path, os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def serialize_chunks(video_dir, chunks):
+    """Return (path, bytes) for all chunks of a video in CHUNK_FORMAT"""
+    if CHUNK_FORMAT == 'parquet':
+        # Columnar + zstd for downstream loaders
+        table = pa.table({key: [chunk[key] for chunk in chunks] for key in chunks[0]})
+        sink = pa.BufferOutputStream()
+        pq.write_table(table, sink, compression='zstd', compression_level=6)
+        return os.path.join(video_dir, 'chunks.parquet'), sink.getvalue().to_pybytes()
+    
+    # One JSON-lines file, one chunk object per line
+    return (os.path.join(video_dir, 'chunks.jsonl'),
+            b''.join(orjson.dumps(chunk) + b"\n" for chunk in chunks))
+
+def save_transcript_chunks(video_id, segments):
+    """Chunk transcript and write it to disk"""
+    chunks = chunk_smart_duration(segments, MIN_CHUNK_DURATION, MAX_CHUNK_DURATION)
+    
+    video_dir = video_dir_for(video_id)
+    os.makedirs(video_dir, exist_ok=True)
+    
+    chunk_durations = [c['duration'] for c in chunks]
+    avg_duration = sum(chunk_durations) / len(chunk_durations) if chunk_durations else 0
+    
+    metadata = {
+        'video_id': video_id,
+        'url': f'https://www.youtube.com/watch?v={video_id}',
+        'total_chunks': len(chunks),
+        'chunk_format': CHUNK_FORMAT,
+        'avg_chunk_duration': avg_duration,
+        'total_duration': segments[-1].start + segments[-1].duration
+    }
+    
+    # Keep the file contents around so the push can stream them to git fast-import
+    files = [
+        # metadata.json stays indented for humans; orjson writes UTF-8 directly
+        (os.path.join(video_dir, 'metadata.json'),
+         orjson.dumps(metadata, option=orjson.OPT_INDENT_2)),
+        serialize_chunks(video_dir, chunks),
+    ]
+    for path, data in files:
+        write_file(path, data)
+    sync_dir(video_dir)
+    
+    return {'success': True, 'chunks': len(chunks), 'avg_chunk_duration': avg_duration, 'files': files}
+
+# youtube-transcript-api raises IpBlocked on HTTP 429 and RequestBlocked when
+# YouTube serves its bot check; both mean "slow down"
+RATE_LIMIT_ERRORS = (yt_errors.IpBlocked, yt_errors.RequestBlocked)
+
+async def fetch_with_backoff(video_id):
+    """Fetch transcript, retrying with truncated exponential backoff on 429"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            # api.fetch is blocking, run it off the event loop
+            return await asyncio.to_thread(api.fetch, video_id, languages=['bn'])
+        except RATE_LIMIT_ERRORS:
+            if attempt == MAX_RETRIES - 1:
+                raise
+        await asyncio.sleep(min(2 ** attempt + random.random(), MAX_BACKOFF))
+
+async def download_transcript_chunks(video_id):
     """Download and chunk transcript"""
     try:
-        transcript = api.fetch(video_id, languages=['bn'])
+        transcript = await fetch_with_backoff(video_id)
         segments = list(transcript)
         
         if not segments:
             return {'success': False, 'error': 'No segments', 'chunks': 0}
         
-        chunks = chunk_smart_duration(segments, MIN_CHUNK_DURATION, MAX_CHUNK_DURATION)
-        
-        video_dir = os.path.join(OUTPUT_DIR, video_id)
-        os.makedirs(video_dir, exist_ok=True)
-        
-        chunk_durations = [c['duration'] for c in chunks]
-        avg_duration = sum(chunk_durations) / len(chunk_durations) if chunk_durations else 0
-        
-        metadata = {
-            'video_id': video_id,
-            'url': f'https://www.youtube.com/watch?v={video_id}',
-            'total_chunks': len(chunks),
-            'avg_chunk_duration': avg_duration,
-            'total_duration': segments[-1].start + segments[-1].duration
-        }
-        
-        with open(os.path.join(video_dir, 'metadata.json'), 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-        
-        for chunk in chunks:
-            chunk_file = os.path.join(video_dir, f'chunk_{chunk["chunk_id"]:04d}.json')
-            with open(chunk_file, 'w', encoding='utf-8') as f:
-                json.dump(chunk, f, ensure_ascii=False, indent=2)
-            
-            txt_file = os.path.join(video_dir, f'chunk_{chunk["chunk_id"]:04d}.txt')
-            with open(txt_file, 'w', encoding='utf-8') as f:
-                f.write(chunk['text'])
-        
-        return {'success': True, 'chunks': len(chunks), 'avg_chunk_duration': avg_duration}
+        return await asyncio.to_thread(save_transcript_chunks, video_id, segments)
         
+    except RATE_LIMIT_ERRORS:
+        return {'success': False, 'error': 'RateLimited', 'chunks': 0}
     except Exception as e:
-        error_msg = str(e)
-        if "429" in error_msg or "Too Many Requests" in error_msg:
-            return {'success': False, 'error': 'RateLimited', 'chunks': 0}
-        return {'success': False, 'error': error_msg[:100], 'chunks': 0}
+        return {'success': False, 'error': str(e)[:100], 'chunks': 0}
 
 # ==============================
 # MAIN LOOP
 # ==============================
+# Offset this run from other platforms started at the same time
+startup_delay = random.uniform(0, STARTUP_JITTER)
+print(f"⏳ Waiting {startup_delay:.1f}s before starting...")
+time.sleep(startup_delay)
+
 print("🚀 Starting downloads...")
 print("=" * 70)
 print()
 
+already_done = len(downloaded)
 processed = 0
+started = 0
 rate_limited = False
-
-for i, video_id in enumerate(batch_videos):
-    total_done = len(downloaded) + processed + 1
+rate_limit_streak = 0
+new_files = []  # (path, bytes) written this batch, committed via git fast-import
+
+def pause_between_videos():
+    """Exponential (Poisson-like) pause so requests don't bunch up"""
+    return min(max(random.expovariate(1.0 / MEAN_WAIT), MIN_WAIT), MAX_WAIT)
+
+def save_progress():
+    """Atomically write completed video IDs to the progress file"""
+    tmp_file = progress_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        # Sorted, one ID per line, so each commit of this file is a small diff
+        f.write(orjson.dumps({
+            'completed': sorted(downloaded),
+            'total': len(all_video_ids),
+            'timestamp': time.time()
+        }, option=orjson.OPT_INDENT_2))
+    os.replace(tmp_file, progress_file)
+
+async def worker(video_id, semaphore):
+    """Download one video, holding a concurrency slot while it runs"""
+    global processed, started, rate_limited, rate_limit_streak
     
-    print(f"📥 [{total_done}/{len(all_video_ids)}] Downloading: {video_id}")
-    
-    result = download_transcript_chunks(video_id)
-    
-    if result['success']:
-        avg_dur = result.get('avg_chunk_duration', 0)
-        print(f"   ✅ Success: {result['chunks']} chunks, avg {avg_dur:.1f}s each")
-        downloaded.add(video_id)
-    else:
-        if result['error'] == 'RateLimited':
-            print(f"   🛑 Rate limited - stopping")
-            rate_limited = True
-            break
+    async with semaphore:
+        if rate_limited:
+            return
+        started += 1
+        
+        print(f"📥 [{already_done + started}/{len(all_video_ids)}] Downloading: {video_id}")
+        
+        result = await download_transcript_chunks(video_id)
+        
+        if result['success']:
+            avg_dur = result.get('avg_chunk_duration', 0)
+            print(f"   ✅ {video_id}: {result['chunks']} chunks, avg {avg_dur:.1f}s each")
+            downloaded.add(video_id)
+            new_files.extend(result['files'])
+            save_progress()
+            rate_limit_streak = 0
+        elif result['error'] == 'RateLimited':
+            # Only give up on the batch after several videos in a row exhaust their retries
+            rate_limit_streak += 1
+            if rate_limit_streak >= RATE_LIMIT_STREAK:
+                print(f"   🛑 {video_id}: Rate limited {rate_limit_streak} videos in a row - stopping")
+                rate_limited = True
+            else:
+                print(f"   ⏭️  {video_id}: Still rate limited after {MAX_RETRIES} attempts - skipping")
         else:
-            print(f"   ❌ Error: {result['error']}")
-    
-    processed += 1
-    
-    # Save progress
-    if processed % SAVE_EVERY == 0:
-        with open(progress_file, 'w') as f:
-            json.dump({
-                'completed': list(downloaded),
-                'total': len(all_video_ids),
-                'timestamp': time.time()
-            }, f)
-        print(f"   💾 Progress saved ({total_done} total)")
-    
-    if i < len(batch_videos) - 1:
-        time.sleep(random.uniform(MIN_WAIT, MAX_WAIT))
+            print(f"   ❌ {video_id}: {result['error']}")
+            rate_limit_streak = 0
+        
+        processed += 1
+        
+        # Keep the slot while waiting so the pacing applies per slot
+        if started < len(batch_videos):
+            await asyncio.sleep(pause_between_videos())
+
+async def download_batch():
+    """Download the batch with up to CONCURRENCY videos in flight"""
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    async with asyncio.TaskGroup() as tg:
+        for video_id in batch_videos:
+            tg.create_task(worker(video_id, semaphore))
+
+asyncio.run(download_batch())
 
 # Final save
-with open(progress_file, 'w') as f:
-    json.dump({
-        'completed': list(downloaded),
-        'total': len(all_video_ids),
-        'timestamp': time.time()
-    }, f)
+save_progress()
 
 # ==============================
 # PUSH TO GITHUB
 # ==============================
 if ENABLE_AUTO_SYNC:
-    push_to_github(len(downloaded))
+    push_to_github(len(downloaded), new_files)
 
 # ==============================
 # SUMMARY